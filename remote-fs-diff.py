@@ -6,18 +6,30 @@ Copyright Robert Krahn 2018
 """
 
 import sys
-from os import uname, stat, walk as dir_walk
-from os.path import join, exists, relpath, realpath, basename, expanduser
+from os import uname, stat, lstat, scandir, cpu_count, sep, makedirs, replace, getpid, fsencode, chmod
+from os.path import join, exists, relpath, realpath, dirname, expanduser
 import fnmatch
+import re
 from time import gmtime, strftime
 import argparse
 import pickle
-from subprocess import PIPE, Popen
-import subprocess
+import gzip
+import zlib
+import hashlib
+import tarfile
+import shlex
+import ctypes
+from subprocess import PIPE, DEVNULL, Popen
 from collections import namedtuple
+from array import array
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread
 import json
+from stat import S_ISREG
 
-from typing import List, IO, cast
+from typing import List, Tuple, Optional, Pattern, Iterable, Iterator, Callable, IO
 
 if sys.version_info.major < 3:
     raise Exception("{} needs python 3".format(__file__))
@@ -53,52 +65,282 @@ def read_default_config():
         default_roots = [expanduser(path) for path in data["roots"]]
 
 
-def apply_ignore(files, root, ignore_files, ignore_paths):
-    """Mutates(!) files (simple file names from os.walk) so that entries matching
-    ignore_files and ignore_paths are removed."""
-    for f in files[:]:
-        removed = False
-        for ign_file in ignore_files:
-            if fnmatch.fnmatch(f, ign_file):
-                files.remove(f)
-                removed = True
-                break
-        if removed:
-            continue
-        for ign_path in ignore_paths:
-            if fnmatch.fnmatch(join(root, f), ign_path):
-                files.remove(f)
+def compile_ignore(patterns: List[str]) -> Pattern:
+    """Combines fnmatch patterns into one regex so that each name needs a
+    single match call instead of one fnmatch per pattern."""
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns) or "(?!)")
+
+
+def apply_ignore(files: List[str], root: str, ignore_files_re: Pattern, ignore_paths_re: Pattern) -> List[str]:
+    """Returns files (simple file names of a directory) without the entries
+    matching ignore_files_re and ignore_paths_re."""
+    return [f for f in files
+            if not ignore_files_re.match(f) and not ignore_paths_re.match(join(root, f))]
 
 
 FileSpec = namedtuple("FileSpec", ["name", "mtime", "size"])
-DirContent = namedtuple("DirContent", ["path", "filespecs"])
+# the files of a directory are stored column-wise: names[i], mtimes[i] and
+# sizes[i] describe one file. The arrays hold plain C values instead of one
+# python object per file, which keeps big indexes small in memory and on the
+# wire. dot_mtime and dot_size are the stats of the directory itself
+DirContent = namedtuple("DirContent", ["path", "dot_mtime", "dot_size", "names", "mtimes", "sizes"])
 FileTree = namedtuple("FileTree", ["rootdir", "dircontents"])
 FileDiff = namedtuple("FileDiff", ["rootdir_a", "rootdir_b", "only_in_a", "only_in_b", "changed"])
 
-def file_spec(f, root):
-    fstat = stat(join(root, f))
-    return FileSpec(f, fstat.st_mtime, fstat.st_size)
-
-def record_file_stats(rootdirs: List[str], ignore_files: List[str], ignore_paths: List[str]) -> List[FileTree]:
+def file_spec(dircontent: DirContent, i: int) -> FileSpec:
+    return FileSpec(dircontent.names[i], dircontent.mtimes[i], dircontent.sizes[i])
+
+def dot_spec(dircontent: DirContent) -> FileSpec:
+    return FileSpec(".", dircontent.dot_mtime, dircontent.dot_size)
+
+def pack_dircontent(dircontent: DirContent) -> DirContent:
+    """For pickling: joins the names of dircontent into a single string, NUL
+    can't be part of a file name. One string per dir pickles much smaller
+    than one per file."""
+    return dircontent._replace(names="\0".join(dircontent.names))
+
+def unpack_dircontent(dircontent: DirContent) -> DirContent:
+    """Reverses pack_dircontent."""
+    names = [sys.intern(name) for name in dircontent.names.split("\0")] if dircontent.names else []
+    return dircontent._replace(names=names)
+
+# statx(2) for --fast-stat, see linux/stat.h
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_MTIME = 0x40
+STATX_SIZE = 0x200
+
+class StatxTimestamp(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_int64),
+                ("tv_nsec", ctypes.c_uint32),
+                ("reserved", ctypes.c_int32)]
+
+class Statx(ctypes.Structure):
+    _fields_ = [("stx_mask", ctypes.c_uint32),
+                ("stx_blksize", ctypes.c_uint32),
+                ("stx_attributes", ctypes.c_uint64),
+                ("stx_nlink", ctypes.c_uint32),
+                ("stx_uid", ctypes.c_uint32),
+                ("stx_gid", ctypes.c_uint32),
+                ("stx_mode", ctypes.c_uint16),
+                ("spare0", ctypes.c_uint16),
+                ("stx_ino", ctypes.c_uint64),
+                ("stx_size", ctypes.c_uint64),
+                ("stx_blocks", ctypes.c_uint64),
+                ("stx_attributes_mask", ctypes.c_uint64),
+                ("stx_atime", StatxTimestamp),
+                ("stx_btime", StatxTimestamp),
+                ("stx_ctime", StatxTimestamp),
+                ("stx_mtime", StatxTimestamp),
+                ("spare", ctypes.c_uint64 * 16)]
+
+@lru_cache(maxsize=None)
+def libc_statx():
+    """libc's statx() or None if there is none (not Linux or glibc < 2.28)."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.POINTER(Statx)]
+    statx.restype = ctypes.c_int
+    return statx
+
+def mtime_and_size(path: str, follow_symlinks=True, fast_stat=False) -> Tuple[float, int]:
+    """Like stat but with fast_stat uses statx with AT_STATX_DONT_SYNC. That
+    lets network file systems such as NFS answer from their attribute cache
+    instead of revalidating with the server. Falls back to a normal stat
+    where statx is missing or fails."""
+    statx = libc_statx() if fast_stat else None
+    if statx:
+        flags = AT_STATX_DONT_SYNC if follow_symlinks else AT_STATX_DONT_SYNC | AT_SYMLINK_NOFOLLOW
+        buf = Statx()
+        if statx(AT_FDCWD, fsencode(path), flags, STATX_MTIME | STATX_SIZE, ctypes.byref(buf)) == 0:
+            # computed like os.stat_result.st_mtime so both compare equal
+            return buf.stx_mtime.tv_sec + buf.stx_mtime.tv_nsec * 1e-9, buf.stx_size
+    fstat = stat(path) if follow_symlinks else lstat(path)
+    return fstat.st_mtime, fstat.st_size
+
+def walk_dir(parentdir: str, rootdir: str, ignore_files_re: Pattern, ignore_paths_re: Pattern,
+             cached: Optional[dict] = None, fast_stat=False) -> Tuple[Optional[DirContent], List[str]]:
+    """Records the files directly inside parentdir. Returns their DirContent
+    and the subdirectories that still need to be walked. Unreadable
+    directories are skipped like os.walk does and yield (None, []).
+    cached is an index from load_index_cache. As long as the mtime of
+    parentdir didn't change its entry tells which files and subdirectories
+    there are, only the files themselves are stat'ed again. fast_stat is
+    passed on to mtime_and_size."""
+    dirs = []
+    file_entries = {}
+    path = relpath(parentdir, rootdir)
+    try:
+        dot_mtime, dot_size = mtime_and_size(parentdir, fast_stat=fast_stat)
+        hit = cached.get(path) if cached else None
+        if hit and hit[0].dot_mtime == dot_mtime:
+            # nothing was added, removed or renamed in parentdir but files
+            # may have been modified in place
+            files = list(hit[0].names)
+            subdirs = hit[1]
+        else:
+            # scandir hands us the entry type from readdir, so we only stat
+            # what we actually record
+            with scandir(parentdir) as entries:
+                for entry in entries:
+                    # symlinks (to dirs as well) are recorded as links: we
+                    # neither descend into nor resolve them
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    else:
+                        file_entries[entry.name] = entry
+            files = apply_ignore(list(file_entries), parentdir, ignore_files_re, ignore_paths_re)
+            dirs = apply_ignore(dirs, parentdir, ignore_files_re, ignore_paths_re)
+            subdirs = [join(parentdir, d) for d in dirs]
+    except OSError:
+        return None, []
+    names = []
+    mtimes = array("d")
+    sizes = array("Q")
+    for f in files:
+        try:
+            if f in file_entries and not fast_stat:
+                fstat = file_entries[f].stat(follow_symlinks=False)
+                mtime, size = fstat.st_mtime, fstat.st_size
+            else:
+                mtime, size = mtime_and_size(join(parentdir, f), follow_symlinks=False, fast_stat=fast_stat)
+        except FileNotFoundError:
+            # removed while walking
+            continue
+        # names like index.html or __init__.py repeat a lot across dirs
+        names.append(sys.intern(f))
+        mtimes.append(mtime)
+        sizes.append(size)
+    return DirContent(path, dot_mtime, dot_size, names, mtimes, sizes), subdirs
+
+def walk_tree(rootdir: str, ignore_files_re: Pattern, ignore_paths_re: Pattern,
+              cached: Optional[dict] = None, fast_stat=False) -> Iterator[DirContent]:
+    """Recursively walks the file system starting at rootdir and yields a
+    DirContent per directory in the order they complete.
+    Directories are read concurrently, the walk is bound by syscall latency
+    (and the GIL is released during those) rather than by CPU.
+    """
+    with ThreadPoolExecutor(max_workers=min(32, (cpu_count() or 1) * 4)) as pool:
+        done: Queue = Queue()
+
+        def submit(parentdir):
+            pool.submit(walk_dir, parentdir, rootdir, ignore_files_re, ignore_paths_re, cached, fast_stat).add_done_callback(done.put)
+
+        submit(rootdir)
+        pending = 1
+        while pending:
+            dircontent, subdirs = done.get().result()
+            pending -= 1
+            if dircontent:
+                yield dircontent
+            for subdir in subdirs:
+                submit(subdir)
+            pending += len(subdirs)
+
+# previous indexes for --incremental, one file per rootdir and ignore settings
+index_cache_dir = expanduser("~/.cache/fsdiff")
+
+def index_cache_file(rootdir: str, ignore_files: List[str], ignore_paths: List[str]) -> str:
+    key = json.dumps([realpath(rootdir), ignore_files, ignore_paths])
+    return join(index_cache_dir, hashlib.sha1(key.encode("utf8")).hexdigest() + ".pkl.gz")
+
+def load_index_cache(cache_file: str, rootdir: str) -> dict:
+    """Reads the dircontents saved by save_index_cache and returns them as
+    {path: (DirContent, subdirs)}, just like walk_dir would return them. If
+    there is no usable cache the result is empty."""
+    try:
+        with gzip.open(cache_file, "rb") as f:
+            dircontents = [unpack_dircontent(dircontent) for dircontent in pickle.load(f)]
+    except (OSError, EOFError, ValueError, zlib.error, pickle.UnpicklingError, AttributeError, TypeError):
+        return {}
+    subdirs: dict = {}
+    for dircontent in dircontents:
+        if dircontent.path != ".":
+            subdirs.setdefault(dirname(dircontent.path) or ".", []).append(join(rootdir, dircontent.path))
+    return {dircontent.path: (dircontent, subdirs.get(dircontent.path, [])) for dircontent in dircontents}
+
+def save_index_cache(cache_file: str, dircontents: List[DirContent]) -> None:
+    makedirs(index_cache_dir, exist_ok=True)
+    tmp_file = "{}.{}".format(cache_file, getpid())
+    with gzip.open(tmp_file, "wb", compresslevel=1) as f:
+        pickle.dump([pack_dircontent(dircontent) for dircontent in dircontents], f, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(tmp_file, cache_file)
+
+def record_file_stats(rootdirs: List[str], ignore_files: List[str], ignore_paths: List[str],
+                      incremental=False, fast_stat=False) -> List[FileTree]:
     """Recursively walks the file_system starting at basedir and for each rootdir
     creates a list of director / file dict tuples like
     [(dir, {file_name1: (mtime, size)})]
+    With incremental, the index of the previous incremental run is used to
+    skip listing directories that didn't change since. fast_stat: see mtime_and_size.
     """
     result = []
+    ignore_files_re = compile_ignore(ignore_files)
+    ignore_paths_re = compile_ignore(ignore_paths)
     for rootdir in rootdirs:
-        dircontents = []
-        for parentdir, dirs, files in dir_walk(rootdir):
-            apply_ignore(files, parentdir, ignore_files, ignore_paths)
-            apply_ignore(dirs, parentdir, ignore_files, ignore_paths)
-            specs = [file_spec(f, parentdir) for f in files if exists(join(parentdir, f))]
-            specs.append(file_spec(".", parentdir))
-            dircontents.append(DirContent(relpath(parentdir, rootdir), specs))
+        cache_file = index_cache_file(rootdir, ignore_files, ignore_paths)
+        cached = load_index_cache(cache_file, rootdir) if incremental else None
+        dircontents = list(walk_tree(rootdir, ignore_files_re, ignore_paths_re, cached, fast_stat))
+        if incremental:
+            save_index_cache(cache_file, dircontents)
         result.append(FileTree(rootdir, dircontents))
 
     return result
 
+# all ssh invocations to the same remote share one connection. Whoever can
+# create the control socket can answer in place of the remote, so it lives
+# in a directory only we can write to. %C is a hash of user, host and port
+ssh_control_dir = join(index_cache_dir, "ssh")
+
+@lru_cache(maxsize=None)
+def ssh_control_path() -> str:
+    makedirs(ssh_control_dir, mode=0o700, exist_ok=True)
+    # mode is only applied when makedirs creates the directory
+    chmod(ssh_control_dir, 0o700)
+    return join(ssh_control_dir, "%C")
+
+def ssh_command(ssh_remote, cmd):
+    return ["ssh",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPersist=60s",
+            "-o", "ControlPath=" + ssh_control_path(),
+            ssh_remote, cmd]
+
+def start_ssh_master(ssh_remote):
+    """Opens the shared ssh connection in the background so that the key
+    exchange overlaps with local work. wait() on the result before the first
+    real remote call."""
+    return Popen(ssh_command(ssh_remote, "true"), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+def remote_shell_path(path: str) -> str:
+    """Quotes path for the remote shell but keeps a leading ~ or ~user
+    unquoted, so that it expands to the home directory on the remote."""
+    home, slash, rest = path.partition("/")
+    if re.match(r"~[\w.-]*$", home):
+        return home + slash + (shlex.quote(rest) if rest else "")
+    return shlex.quote(path)
+
+def read_in_background(stream: IO[bytes]) -> Callable[[], bytes]:
+    """Reads stream to its end in a thread so that a process writing a lot to
+    it can't block on a full pipe while we wait for its other output. Call
+    the result to get the data, that waits for the end of the stream."""
+    data: list = []
+    reader = Thread(target=lambda: data.append(stream.read()), daemon=True)
+    reader.start()
+
+    def result() -> bytes:
+        reader.join()
+        return data[0] if data else b""
+
+    return result
+
 def remote_command(ssh_remote, cmd):
-    p = Popen(["ssh", ssh_remote, cmd], stdout=PIPE, stderr=PIPE)
+    p = Popen(ssh_command(ssh_remote, cmd), stdout=PIPE, stderr=PIPE)
     out = p.stdout.read().decode("utf8")
     err = p.stderr.read().decode("utf8")
     if len(err) > 0:
@@ -106,50 +348,195 @@ def remote_command(ssh_remote, cmd):
     return out
 
 
-def record_file_stats_remote(ssh_remote, rootdirs: List[str]) -> List[FileTree]:
-    """Copies this script to the remote host, runs it, and sends back a serialized
-    file index."""
-    # print(remote_command(ssh_remote, "PATH=/usr/local/opt/pyenv/versions/3.6.3/bin:/usr/local/bin:$PATH python --version"))
+@lru_cache(maxsize=None)
+def compressed_source() -> bytes:
+    """This script, read once and zlib compressed for sending it to remotes.
+    Note that __file__ is not defined when running on the remote."""
+    with open(__file__, "rb") as code_file:
+        return zlib.compress(code_file.read(), 9)
 
-    with open(__file__, "r+b") as code_file:
-        cmd = "export PATH=/usr/local/opt/pyenv/versions/3.6.3/bin:/usr/local/bin:$PATH; cat - > $TMPDIR/{0} && python3 $TMPDIR/{0} --print-index --roots {1}".format(
-            basename(__file__), " ".join(rootdirs))
-        p = Popen(["ssh", ssh_remote, cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate(input=code_file.read())
-        if len(err) > 0:
-            raise Exception("Error on remote: ", err)
-        return pickle.loads(out)
-
-def dump_file_stats(rootdirs: List[str], ignore_files: List[str], ignore_paths: List[str]) -> None:
-    """serializes dict produced by record_file_stats"""
-    data = record_file_stats(rootdirs, ignore_files, ignore_paths)
-    out = cast(IO[bytes], sys.stdout.buffer if hasattr(sys.stdout, "buffer") else sys.stdout)
-    pickle.dump(data, out)
-
-def diff_file_remote(filename, basedir, ssh_remote, remote_base_dir):
-    """Runs the diff command on contents of filename, locally and remotely."""
-    remote_diff = subprocess.run(
-        ["ssh", ssh_remote, "cat '{}'".format(join(remote_base_dir, filename))],
-        stdout=PIPE, stderr=PIPE)
-    if len(remote_diff.stderr) > 0:
-        raise Exception("Error on remote while fetching content: ", remote_diff.stderr)
-    diff = Popen(["diff", "-u", join(basedir, filename), "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    out, err = diff.communicate(input=remote_diff.stdout)
-    if len(err) > 0:
-        raise Exception("Error in diff: ", err)
-    return out.decode("utf-8")
+def record_file_stats_remote(ssh_remote, rootdirs: List[str], incremental=False, fast_stat=False) -> Iterator[FileTree]:
+    """Copies this script to the remote host, runs it, and yields the file
+    trees of the serialized index it sends back."""
+    # print(remote_command(ssh_remote, "PATH=/usr/local/opt/pyenv/versions/3.6.3/bin:/usr/local/bin:$PATH python --version"))
 
+    # the remote python reads the compressed script from stdin and runs it
+    # as __main__, no temp file needed
+    cmd = "export PATH=/usr/local/opt/pyenv/versions/3.6.3/bin:/usr/local/bin:$PATH; python3 -c 'import sys, zlib; exec(zlib.decompress(sys.stdin.buffer.read()))' --print-index --pickle-protocol {0}{1}{2} --roots {3}".format(
+        pickle.HIGHEST_PROTOCOL, " --incremental" if incremental else "", " --fast-stat" if fast_stat else "",
+        " ".join(remote_shell_path(rootdir) for rootdir in rootdirs))
+    # unbuffered, so that the gzip reader gets each flushed record right away
+    # instead of waiting for a BufferedReader to fill up
+    p = Popen(ssh_command(ssh_remote, cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0)
+    stderr = read_in_background(p.stderr)
+    # the remote consumes all of stdin before it starts writing, so no
+    # need to interleave writes and reads here
+    try:
+        # raw pipe writes may be partial
+        source = memoryview(compressed_source())
+        while source:
+            source = source[p.stdin.write(source):]
+        p.stdin.close()
+    except BrokenPipeError:
+        # ssh is already gone, its stderr tells why
+        pass
+
+    # decode the index while it arrives. Each tree is handed out as soon as
+    # the remote is done with it so diffing overlaps with the remote walk
+    dircontents: list = []
+    trees_done = 0
+    tree = None
+    try:
+        with gzip.GzipFile(fileobj=p.stdout, mode="rb") as index_stream:
+            for root_index, dircontent in read_index_records(index_stream):
+                if dircontent is not None:
+                    dircontents.append(unpack_dircontent(dircontent))
+                    continue
+                tree = FileTree(rootdirs[root_index], dircontents)
+                dircontents = []
+                trees_done += 1
+                if trees_done == len(rootdirs):
+                    break
+                yield tree
+    except (EOFError, OSError, ValueError, pickle.UnpicklingError):
+        pass
+    # the last tree is only handed out after the remote finished cleanly
+    err = stderr()
+    p.wait()
+    if len(err) > 0 or trees_done < len(rootdirs):
+        raise Exception("Error on remote: ", err)
+    yield tree
+
+def write_index_record(pickler: pickle.Pickler, record: tuple) -> None:
+    """Writes record as a pickle of its own, pickles end with a STOP opcode so
+    they can be read back one after another without any extra framing."""
+    pickler.dump(record)
+    # records share nothing, don't let the memo keep them alive
+    pickler.clear_memo()
+
+def read_index_records(stream: IO[bytes]) -> Iterator[tuple]:
+    """Reads the records written by write_index_record until the stream ends."""
+    while True:
+        try:
+            record = pickle.load(stream)
+        except EOFError:
+            return
+        yield record
+
+def dump_file_stats(rootdirs: List[str], ignore_files: List[str], ignore_paths: List[str],
+                    incremental=False, fast_stat=False, protocol=pickle.DEFAULT_PROTOCOL) -> None:
+    """Streams the index of rootdirs to stdout as (root index, DirContent)
+    records while walking. A (root index, None) record ends each root.
+    protocol is the pickle protocol, it must be one the receiving python
+    understands."""
+    ignore_files_re = compile_ignore(ignore_files)
+    ignore_paths_re = compile_ignore(ignore_paths)
+    # file paths compress well, so gzip pays for itself over ssh
+    with gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb", compresslevel=6) as index_stream:
+        pickler = pickle.Pickler(index_stream, protocol=min(protocol, pickle.HIGHEST_PROTOCOL))
+        for root_index, rootdir in enumerate(rootdirs):
+            cache_file = index_cache_file(rootdir, ignore_files, ignore_paths)
+            cached = load_index_cache(cache_file, rootdir) if incremental else None
+            dircontents = []
+            for dircontent in walk_tree(rootdir, ignore_files_re, ignore_paths_re, cached, fast_stat):
+                write_index_record(pickler, (root_index, pack_dircontent(dircontent)))
+                if incremental:
+                    dircontents.append(dircontent)
+            write_index_record(pickler, (root_index, None))
+            # let the receiver start on this root right away
+            index_stream.flush()
+            if incremental:
+                save_index_cache(cache_file, dircontents)
+
+def write_in_background(stream: IO[bytes], data: bytes) -> None:
+    """Writes data to stream and closes it from a thread, so that a process
+    that produces output while still reading its input can't deadlock with
+    us. A process that exits early is not an error here, its stderr and
+    exit status tell what went wrong."""
+    def write():
+        try:
+            stream.write(data)
+            stream.close()
+        except BrokenPipeError:
+            pass
+    Thread(target=write, daemon=True).start()
+
+def diff_files_remote(filenames: List[str], basedir, ssh_remote, remote_base_dir) -> List[str]:
+    """Runs the diff command on contents of filenames, locally and remotely.
+    The remote files are fetched with a single ssh call as one tar stream."""
+    if not filenames:
+        return []
+    # the names go over stdin, NUL separated, so their number isn't limited
+    # by the maximum command line length
+    tar_cmd = "tar -c -f - -C {} --null -T -".format(remote_shell_path(remote_base_dir))
+    remote_tar = Popen(ssh_command(ssh_remote, tar_cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stderr = read_in_background(remote_tar.stderr)
+    write_in_background(remote_tar.stdin, b"".join(fsencode(filename) + b"\0" for filename in filenames))
+    diffs = []
+    hostname = uname().nodename
+    complete = False
+    try:
+        with tarfile.open(fileobj=remote_tar.stdout, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    diffs.append("Skipped {}: not a regular file on {}\n".format(member.name, ssh_remote))
+                    continue
+                local_path = join(basedir, member.name)
+                try:
+                    local_is_file = S_ISREG(lstat(local_path).st_mode)
+                except OSError:
+                    local_is_file = False
+                if not local_is_file:
+                    diffs.append("Skipped {}: not a regular file on {}\n".format(member.name, hostname))
+                    continue
+                content = tar.extractfile(member).read()
+                diff = Popen(["diff", "-u", local_path, "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                out, err = diff.communicate(input=content)
+                if len(err) > 0:
+                    # one file that can't be diffed shouldn't cost the whole report
+                    diffs.append("Error in diff of {}: {}\n".format(member.name, err.decode("utf-8", errors="replace").strip()))
+                    continue
+                diffs.append(out.decode("utf-8", errors="replace"))
+        complete = True
+    except (tarfile.TarError, EOFError):
+        # empty or truncated tar stream, the remote stderr tells why
+        pass
+    err = stderr()
+    remote_tar.wait()
+    if len(err) > 0 or not complete:
+        raise Exception("Error on remote while fetching content: ", err)
+    return diffs
+
+
+
+def topmost_dirs(paths: Iterable[str]) -> List[str]:
+    """Those of the relative dir paths that are not below another one of them,
+    sorted."""
+    result: list = []
+    prefix: Optional[str] = None
+    # in this order each dir is directly followed by its subdirs, so the
+    # prefix of the last reported dir is all we need to skip those
+    for path in sorted(paths, key=lambda path: (path != ".", path.split(sep))):
+        if prefix is not None and path.startswith(prefix):
+            continue
+        result.append(path)
+        prefix = "" if path == "." else path + sep
+    return result
 
+# seconds two mtimes may differ and still count as equal
+mtime_tolerance = 1
 
 # record_file_stats("/Users/robert/org/website/content", [], [])
 # 123
 
-def diff_file_list(filetrees_a: List[FileTree], filetrees_b: List[FileTree]) -> List[FileDiff]:
+def diff_file_list(filetrees_a: Iterable[FileTree], filetrees_b: Iterable[FileTree]) -> List[FileDiff]:
     """builds a dict {
-      only_in_a: {filename: (mtime, size)},
-      only_in_b: {filename:, (mtime, size))},
-      changed: {filename: ((mtimea, sizea), (mtimeb, sizeb))}
-    }"""
+      only_in_a: {(dir, filename): (mtime, size)},
+      only_in_b: {(dir, filename):, (mtime, size))},
+      changed: {(dir, filename): ((mtimea, sizea), (mtimeb, sizeb))}
+    }
+    Dirs only in a or b are recorded as (dir, ""). The paths are only joined
+    when printing."""
     filediffs: list = []
 
     # each file tree contains the file specs starting from a root
@@ -157,67 +544,53 @@ def diff_file_list(filetrees_a: List[FileTree], filetrees_b: List[FileTree]) ->
     # correspond to each other: they might not have the same rootdir but the
     # files in them are to be diffed
     for (rootdir_a, dirs_a), (rootdir_b, dirs_b) in zip(filetrees_a, filetrees_b):
-        only_in_a: dict = {}
-        only_in_b: dict = {}
-        changed: dict = {}
-        seen_dirs: set = set()
-
-        # for all files in a...
-        for path, files_a in dirs_a:
-            seen_dirs.add(path)
-
-            # ... is a parent directory to be known to be only in filetree_a? If so, ignore this dir.
-            parent_excluded = next((True for only_in_a_dir in only_in_a if path.startswith(only_in_a_dir)), None)
-            if parent_excluded:
-                continue
-
-            # if we don't find a dir with the same relative path in b, we add
-            # just the path to this dir to only_in_a and ignore all the files
-            dir_b = next((dir_b for dir_b in dirs_b if dir_b.path == path), None)
-            if not dir_b:
-                only_in_a[path + "/"] = next(filespec for filespec in files_a if filespec.name == ".")
-
-            else:
-                # dir with the same relative path exists in a and in b. we have
-                # to compare the individual files
-                seen_files: set = set()
-                files_in_a: dict = {}
-                files_in_b: dict = {}
-                changed_files: dict = {}
-                path_b, files_b = dir_b
-                for file_a in files_a:
-                    if file_a.name == ".":
-                        continue
-                    seen_files.add(file_a.name)
-
-                    # do we find two files with the same name?
-                    # no: mark file as only in a
-                    # yes: compare size and record in changed if it differs
-                    file_b = next((filespec for filespec in files_b if filespec.name == file_a.name), None)
-                    if not file_b:
-                        files_in_a[join(path, file_a.name)] = file_a
-                    elif file_a.size != file_b.size:
-                        changed_files[join(path, file_a.name)] = (file_a, file_b)
-
-                # housekeeping
-                files_in_b.update([(join(path, file_b.name), file_b)
-                                   for file_b in files_b
-                                   if file_b.name not in seen_files and file_b.name != "."])
-                only_in_a.update(files_in_a)
-                only_in_b.update(files_in_b)
-                changed.update(changed_files)
-
-        # we looked at all directories in a. time to record directories in b
-        # that don't exist in a
-        for path, files_b in dirs_b:
-            parent_excluded = next((True for only_in_b_dir in only_in_b if path.startswith(only_in_b_dir)), None)
-            if parent_excluded:
-                continue
-
-            if path not in seen_dirs:
-                only_in_b[path + "/"] = next(filespec for filespec in files_b if filespec.name == ".")
-
-        filediffs.append(FileDiff(rootdir_a, rootdir_b, only_in_a, only_in_b, changed))
+        # ((path, name), spec) items, turned into dicts once the whole tree is done
+        only_in_a: list = []
+        only_in_b: list = []
+        changed: list = []
+        dirs_a_by_path = {dir_a.path: dir_a for dir_a in dirs_a}
+        dirs_b_by_path = {dir_b.path: dir_b for dir_b in dirs_b}
+        paths_a = dirs_a_by_path.keys()
+        paths_b = dirs_b_by_path.keys()
+
+        # for dirs only in a or only in b we add just the path of the topmost
+        # such dir and ignore everything below it
+        only_in_a.extend(((path, ""), dot_spec(dirs_a_by_path[path]))
+                         for path in topmost_dirs(paths_a - paths_b))
+        only_in_b.extend(((path, ""), dot_spec(dirs_b_by_path[path]))
+                         for path in topmost_dirs(paths_b - paths_a))
+
+        # dirs with the same relative path exist in a and in b. we have to
+        # compare the individual files
+        for path in paths_a & paths_b:
+            dir_a = dirs_a_by_path[path]
+            dir_b = dirs_b_by_path[path]
+            names_a = set(dir_a.names)
+            index_b = {name: i for i, name in enumerate(dir_b.names)}
+            mtimes_a, sizes_a = dir_a.mtimes, dir_a.sizes
+            mtimes_b, sizes_b = dir_b.mtimes, dir_b.sizes
+            # do we find two files with the same name?
+            # no: mark file as only in a / only in b
+            # yes: compare size and mtime and record in changed if
+            # either differs. mtimes get a second of slack for
+            # file systems with coarse timestamps
+            only_in_a.extend(((path, name), file_spec(dir_a, i))
+                             for i, name in enumerate(dir_a.names)
+                             if name not in index_b)
+            only_in_b.extend(((path, name), file_spec(dir_b, i))
+                             for i, name in enumerate(dir_b.names)
+                             if name not in names_a)
+            in_both = [(i, index_b[name])
+                       for i, name in enumerate(dir_a.names)
+                       if name in index_b]
+            changed.extend(((path, dir_a.names[i]), (file_spec(dir_a, i), file_spec(dir_b, j)))
+                           for i, j in in_both
+                           if sizes_a[i] != sizes_b[j] or abs(mtimes_a[i] - mtimes_b[j]) > mtime_tolerance)
+
+        # the trees come in walk order, sorting just the (few) results keeps
+        # the output stable
+        filediffs.append(FileDiff(rootdir_a, rootdir_b,
+                                  dict(sorted(only_in_a)), dict(sorted(only_in_b)), dict(sorted(changed))))
 
     return filediffs
 
@@ -227,20 +600,9 @@ def print_diff(diffed: List[FileDiff], print_ediff=False, print_content_diff=Fal
         return strftime("%Y-%m-%d %H:%M:%S", gmtime(t))
 
     def print_aligned(prefix, items, str_col_0_fn, str_col_1_fn):
-        lines = []
-        times = [None] * (len(prefix.splitlines()) - 1)
-        max_len = 0
-        lines.append(prefix)
-        for item in items:
-            col0 = str_col_0_fn(item)
-            lines.append(col0)
-            max_len = max(max_len, len(col0))
-            times.append(str_col_1_fn(item))
-        for i, line in enumerate(lines):
-            if times[i] is None:
-                continue
-            lines[i] = lines[i].ljust(max_len + 1, " ") + "| " + times[i]
-        return lines
+        rows = [(str_col_0_fn(item), str_col_1_fn(item)) for item in items]
+        max_len = max((len(col0) for col0, _ in rows), default=0)
+        return [prefix] + ["{:<{}}| {}".format(col0, max_len + 1, col1) for col0, col1 in rows]
 
     hostname = uname().nodename
     lines = []
@@ -249,7 +611,7 @@ def print_diff(diffed: List[FileDiff], print_ediff=False, print_content_diff=Fal
         lines.extend(print_aligned(
             ">>> The following files are only present in {}:{}\n ".format(hostname, diff.rootdir_a),
             diff.only_in_a.items(),
-            lambda item: item[0],
+            lambda item: join(*item[0]),
             lambda item: prin_time(item[1].mtime)))
         lines.append("\n")
 
@@ -259,7 +621,7 @@ def print_diff(diffed: List[FileDiff], print_ediff=False, print_content_diff=Fal
         lines.extend(print_aligned(
             "<<< The following files are only present in {}:{}\n ".format(ssh_remote, diff.rootdir_b),
             diff.only_in_b.items(),
-            lambda item: item[0],
+            lambda item: join(*item[0]),
             lambda item: prin_time(item[1].mtime)))
         lines.append("\n")
 
@@ -269,7 +631,7 @@ def print_diff(diffed: List[FileDiff], print_ediff=False, print_content_diff=Fal
         lines.extend(print_aligned(
             "=== The following files are changed {}:{} <=> {}:{}\n ".format(hostname, diff.rootdir_a, ssh_remote, diff.rootdir_b),
             diff.changed.items(),
-            lambda item: item[0],
+            lambda item: join(*item[0]),
             lambda item: "{} | {} | {}".format(
                 "A" if item[1][0].mtime > item[1][1].mtime else "B",
                 prin_time(item[1][0].mtime), prin_time(item[1][1].mtime))))
@@ -281,15 +643,15 @@ def print_diff(diffed: List[FileDiff], print_ediff=False, print_content_diff=Fal
             lines.append("\n")
             lines.extend([
                 "(let ((f1 \"{0}\") (f2 \"{1}\")) (ediff-files f1 (concat \"/ssh:{2}:\" f2)))".format(
-                    join(diff.rootdir_a, file), join(diff.rootdir_b, file), ssh_remote)
+                    join(diff.rootdir_a, *file), join(diff.rootdir_b, *file), ssh_remote)
                 for file in diff.changed])
 
-    # if print_content_diff:
-    #     lines.append("\n")
-    #     lines.extend([diff_file_remote(file, basedir, ssh_remote, remote_basedir)
-    #                   for file in diffed["changed"]])
+    if print_content_diff:
+        for diff in diffed:
+            lines.append("\n")
+            lines.extend(diff_files_remote([join(*file) for file in diff.changed], diff.rootdir_a, ssh_remote, diff.rootdir_b))
 
-    print("\n".join(lines))
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":
@@ -298,22 +660,28 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compare file trees remotely')
     parser.add_argument('--roots', type=str, nargs='+', help='Base directories to operate from. Seperate multiple directories via spaces. If a directory string contains a ":" then the left part of the string is the local directory, the right side the directory of the remote.', default=default_roots)
     parser.add_argument('--print-index', action="store_true", help='Build and print the index of files. Not meant for direct usage but for remote communication via ssh. Will print a pickled index to stdout.')
+    parser.add_argument('--pickle-protocol', type=int, default=pickle.DEFAULT_PROTOCOL, help='Pickle protocol for --print-index. Set by the local side to the highest protocol it can read.')
     parser.add_argument('--ignore-files', type=str, nargs='+', help='file names and patterns to ignore', default=default_ignore_files)
     parser.add_argument('--ignore-paths', type=str, nargs='+', help='paths and path patterns to ignore', default=default_ignore_paths)
     parser.add_argument('--ssh-remote', type=str, help='passed to ssh. Typically user@host of remote.')
     parser.add_argument('--print-ediff-commands', action="store_true", help='Print ediff function calls for changed files. For copy and paste into emacs.')
     parser.add_argument('--print-content-diff', action="store_true", help='Do a full unified diff of all changed files.')
+    parser.add_argument('--fast-stat', action="store_true", help='On Linux, stat files with statx and AT_STATX_DONT_SYNC, locally and remotely. Network file systems like NFS then answer from their attribute cache instead of asking the server, which is much faster but may report slightly outdated mtimes and sizes. No effect on local file systems.')
+    parser.add_argument('--incremental', action="store_true", help='Remember the index in ~/.cache/fsdiff and on the next run skip listing directories whose mtime did not change, locally and remotely. Their files are still checked, so in-place modifications are noticed.')
     args = parser.parse_args()
 
     localdirs = [dir.split(":")[0] if ":" in dir else dir for dir in args.roots]
     remotedirs = [dir.split(":")[1] if ":" in dir else dir for dir in args.roots]
 
     if args.print_index:
-        dump_file_stats(localdirs, args.ignore_files, args.ignore_paths)
+        dump_file_stats(localdirs, args.ignore_files, args.ignore_paths, incremental=args.incremental, fast_stat=args.fast_stat,
+                        protocol=args.pickle_protocol)
 
     elif args.ssh_remote:
-        files_a = record_file_stats(localdirs, args.ignore_files, args.ignore_paths)
-        files_b = record_file_stats_remote(args.ssh_remote, remotedirs)
+        ssh_master = start_ssh_master(args.ssh_remote)
+        files_a = record_file_stats(localdirs, args.ignore_files, args.ignore_paths, incremental=args.incremental, fast_stat=args.fast_stat)
+        ssh_master.wait()
+        files_b = record_file_stats_remote(args.ssh_remote, remotedirs, incremental=args.incremental, fast_stat=args.fast_stat)
         diffed = diff_file_list(files_a, files_b)
         print_diff(diffed,
                    print_ediff=args.print_ediff_commands,